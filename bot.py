@@ -14,11 +14,11 @@ from types import SimpleNamespace
 
 import discord
 import isodate
-from aiohttp import ClientSession
+from aiohttp import ClientSession, TCPConnector
 from discord.ext import commands, tasks
 from discord.ext.commands.view import StringView
 from emoji import UNICODE_EMOJI
-from pkg_resources import parse_version
+from packaging.version import parse as parse_version
 
 from core.utils import tryint
 
@@ -163,7 +163,11 @@ class ModmailBot(commands.Bot):
     @property
     def session(self) -> ClientSession:
         if self._session is None:
-            self._session = ClientSession(loop=self.loop)
+            # Keep-alive connections are shared, e.g. by concurrent plugin downloads
+            connector = TCPConnector(
+                limit_per_host=8, ttl_dns_cache=300, enable_cleanup_closed=True, loop=self.loop
+            )
+            self._session = ClientSession(connector=connector, loop=self.loop)
         return self._session
 
     @property
@@ -1,22 +1,29 @@
 import asyncio
-import io
 import json
 import os
+import re
 import shutil
 import sys
+import tarfile
 import typing
-import zipfile
+from collections import defaultdict
 from importlib import invalidate_caches
 from difflib import get_close_matches
 from pathlib import Path, PurePath
-from re import match
 from site import USER_SITE
 from subprocess import PIPE
 
 import discord
+from aiohttp import ClientError
 from discord.ext import commands
 
-from pkg_resources import parse_version
+from packaging.version import parse as parse_version
+
+try:
+    # noinspection PyUnresolvedReferences
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 from core import checks
 from core.models import PermissionLevel, getLogger
@@ -25,19 +32,64 @@ from core.utils import truncate, trigger_typing
 
 logger = getLogger(__name__)
 
+_ROOT = Path(__file__).absolute().parent.parent
+
+_GZIP_MAGIC = b"\x1f\x8b"
+
+_LOOSE = re.compile(r"^(.+?)/(.+?)/(.+?)(?:@(.+?))?$")
+_STRICT = re.compile(r"^(.+?)/(.+?)/(.+?)@(.+?)$")
+
 
 class InvalidPluginError(commands.BadArgument):
     pass
 
 
+async def _read_lines(stream, callback):
+    async for line in stream:
+        # pip writes in the locale encoding when piped, which may not be UTF-8
+        callback(line.decode(errors="replace").rstrip())
+
+
+def _extract_plugin(archive_path, name, dest):
+    """Synchronously extracts the ``name`` directory of a repo archive into ``dest``."""
+    # "r|gz" reads the archive as a forward-only stream, so memory stays constant
+    with tarfile.open(archive_path, "r|gz") as tarf:
+        # Each directory only needs to be created once, not once per file inside it
+        created = set()
+        needle = f"/{name}/"
+        for member in tarf:
+            # Entries of other plugins in the repo are rejected without splitting their name
+            if not member.name.startswith(needle, member.name.find("/")):
+                continue
+
+            # Archive member names are always "/" separated
+            parts = member.name.rstrip("/").split("/")
+            if len(parts) >= 3:
+                plugin_path = dest.joinpath(*parts[2:])
+                if member.isdir():
+                    plugin_path.mkdir(parents=True, exist_ok=True)
+                    created.add(plugin_path)
+                elif member.isfile():
+                    if plugin_path.parent not in created:
+                        plugin_path.parent.mkdir(parents=True, exist_ok=True)
+                        created.add(plugin_path.parent)
+                    with tarf.extractfile(member) as src, plugin_path.open("wb") as dst:
+                        # Most plugin files fit in a single read with a 1 MiB buffer
+                        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
 class Plugin:
     def __init__(self, user, repo, name, branch=None):
         self.user = user
         self.repo = repo
         self.name = name
         self.branch = branch if branch is not None else "master"
-        self.url = f"https://github.com/{user}/{repo}/archive/{self.branch}.zip"
+        self.url = f"https://github.com/{user}/{repo}/archive/{self.branch}.tar.gz"
         self.link = f"https://github.com/{user}/{repo}/tree/{self.branch}/{name}"
+        # Precomputed as plugins are hashed, compared and sorted a lot
+        self._key = (user, repo, name, self.branch)
+        self._str = f"{user}/{repo}/{name}@{self.branch}"
+        self._name_lower = name.lower()
 
     @property
     def path(self):
@@ -45,45 +97,40 @@ class Plugin:
 
     @property
     def abs_path(self):
-        return Path(__file__).absolute().parent.parent / self.path
+        return _ROOT / self.path
 
     @property
     def cache_path(self):
-        return (
-            Path(__file__).absolute().parent.parent
-            / "temp"
-            / "plugins-cache"
-            / f"{self.user}-{self.repo}-{self.branch}.zip"
-        )
+        return _ROOT / "temp" / "plugins-cache" / f"{self.user}-{self.repo}-{self.branch}.tar.gz"
 
     @property
     def ext_string(self):
         return f"plugins.{self.user}.{self.repo}.{self.name}-{self.branch}.{self.name}"
 
     def __str__(self):
-        return f"{self.user}/{self.repo}/{self.name}@{self.branch}"
+        return self._str
 
     def __lt__(self, other):
-        return self.name.lower() < other.name.lower()
+        return self._name_lower < other._name_lower
 
     @classmethod
     def from_string(cls, s, strict=False):
         if not strict:
-            m = match(r"^(.+?)/(.+?)/(.+?)(?:@(.+?))?$", s)
+            m = _LOOSE.match(s)
         else:
-            m = match(r"^(.+?)/(.+?)/(.+?)@(.+?)$", s)
+            m = _STRICT.match(s)
         if m is not None:
             return Plugin(*m.groups())
         raise InvalidPluginError("Cannot decipher %s.", s)  # pylint: disable=raising-format-tuple
 
     def __hash__(self):
-        return hash((self.user, self.repo, self.name, self.branch))
+        return hash(self._key)
 
     def __repr__(self):
-        return f"<Plugins: {self.__str__()}>"
+        return f"<Plugins: {self._str}>"
 
     def __eq__(self, other):
-        return isinstance(other, Plugin) and self.__str__() == other.__str__()
+        return isinstance(other, Plugin) and self._key == other._key
 
 
 class Plugins(commands.Cog):
@@ -99,8 +146,14 @@ class Plugins(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.registry = {}
+        self.registry_lower = {}
         self.loaded_plugins = set()
         self._ready_event = asyncio.Event()
+        # Caps the number of concurrent GitHub fetches
+        self._sem = asyncio.Semaphore(8)
+        # pip is not safe to run concurrently against the same site-packages
+        self._pip_lock = asyncio.Lock()
+        self._cache_locks = defaultdict(asyncio.Lock)
 
         self.bot.loop.create_task(self.populate_registry())
 
@@ -111,38 +164,98 @@ class Plugins(commands.Cog):
 
     async def populate_registry(self):
         url = "https://raw.githubusercontent.com/kyb3r/modmail/master/plugins/registry.json"
-        async with self.bot.session.get(url) as resp:
-            self.registry = json.loads(await resp.text())
+        cache_path = _ROOT / "temp" / "registry.json"
+
+        cached = None
+        headers = {}
+        if cache_path.exists():
+            try:
+                cached = json_loads(cache_path.read_bytes())
+                if not isinstance(cached, dict) or not isinstance(cached.get("registry"), dict):
+                    raise ValueError("Malformed registry cache")
+            except ValueError:
+                cached = None
+                logger.warning("Ignoring corrupt registry cache %s.", cache_path)
+            else:
+                if cached.get("etag"):
+                    headers["If-None-Match"] = cached["etag"]
+                if cached.get("last_modified"):
+                    headers["If-Modified-Since"] = cached["last_modified"]
+
+        try:
+            async with self.bot.session.get(url, headers=headers) as resp:
+                if resp.status == 304 and cached is not None:
+                    logger.debug("Registry not modified, using cached copy.")
+                    registry = cached["registry"]
+                elif resp.status != 200 and cached is not None:
+                    logger.warning(
+                        "Failed to fetch the plugin registry (HTTP %s), using cached copy.",
+                        resp.status,
+                    )
+                    registry = cached["registry"]
+                else:
+                    registry = json_loads(await resp.read())
+                    cached = {
+                        "etag": resp.headers.get("ETag"),
+                        "last_modified": resp.headers.get("Last-Modified"),
+                        "registry": registry,
+                    }
+                    cache_path.write_text(json.dumps(cached))
+        except (ClientError, asyncio.TimeoutError):
+            if cached is None:
+                raise
+            logger.warning(
+                "Failed to fetch the plugin registry, using cached copy.", exc_info=True
+            )
+            registry = cached["registry"]
+
+        # Lets users type registry plugin names in any case
+        self.registry_lower = {name.lower(): name for name in registry}
+        self.registry = registry
 
     async def initial_load_plugins(self):
         await self.bot.wait_for_connected()
 
-        for plugin_name in list(self.bot.config["plugins"]):
+        plugin_names = list(self.bot.config["plugins"])
+        results = await asyncio.gather(
+            *(self._prepare(plugin_name) for plugin_name in plugin_names), return_exceptions=True
+        )
+        results = [(None, res) if isinstance(res, BaseException) else res for res in results]
+
+        # Resolve the requirements of every downloaded plugin with a single pip run
+        downloaded = [plugin for plugin, exc in results if plugin is not None and exc is None]
+        batched = await self.install_batched_requirements(downloaded)
+
+        for i, (plugin, exc) in enumerate(results):
+            if plugin is None or exc is not None:
+                continue
             try:
-                plugin = Plugin.from_string(plugin_name, strict=True)
-            except InvalidPluginError:
+                await self.load_plugin(plugin, install_requirements=not batched)
+            except Exception as load_exc:
+                results[i] = plugin, load_exc
+
+        # Config mutations are applied here, after every plugin has settled
+        for plugin_name, (plugin, exc) in zip(plugin_names, results):
+            if plugin is None:
                 self.bot.config["plugins"].remove(plugin_name)
-                try:
-                    # For backwards compat
-                    plugin = Plugin.from_string(plugin_name)
-                except InvalidPluginError:
-                    logger.error("Failed to parse plugin name: %s.", plugin_name, exc_info=True)
-                    continue
+                logger.error("Failed to parse plugin name: %s.", plugin_name, exc_info=exc)
+                continue
 
+            if str(plugin) != plugin_name:
+                self.bot.config["plugins"].remove(plugin_name)
                 logger.info("Migrated legacy plugin name: %s, now %s.", plugin_name, str(plugin))
-                self.bot.config["plugins"].append(str(plugin))
+                if exc is None:
+                    self.bot.config["plugins"].append(str(plugin))
 
-            try:
-                await self.download_plugin(plugin)
-                await self.load_plugin(plugin)
-            except Exception:
+            elif exc is not None:
                 self.bot.config["plugins"].remove(plugin_name)
+
+            if exc is not None:
                 logger.error(
                     "Error when loading plugin %s. Plugin removed from config.",
                     plugin,
-                    exc_info=True,
+                    exc_info=exc,
                 )
-                continue
 
         logger.debug("Finished loading all plugins.")
 
@@ -151,91 +264,149 @@ class Plugins(commands.Cog):
         self._ready_event.set()
         await self.bot.config.update()
 
+    async def _prepare(self, plugin_name):
+        """
+        Parses and downloads a single plugin from the config.
+
+        Returns a ``(plugin, exc)`` tuple, ``plugin`` is ``None`` when the name
+        could not be parsed. Never mutates the config.
+        """
+        try:
+            plugin = Plugin.from_string(plugin_name, strict=True)
+        except InvalidPluginError:
+            try:
+                # For backwards compat
+                plugin = Plugin.from_string(plugin_name)
+            except InvalidPluginError as exc:
+                return None, exc
+
+        try:
+            await self.download_plugin(plugin)
+        except Exception as exc:
+            return plugin, exc
+        return plugin, None
+
     async def download_plugin(self, plugin, force=False):
         if plugin.abs_path.exists() and not force:
             return
 
         plugin.abs_path.mkdir(parents=True, exist_ok=True)
 
-        if plugin.cache_path.exists() and not force:
-            plugin_io = plugin.cache_path.open("rb")
-            logger.debug("Loading cached %s.", plugin.cache_path)
-        else:
-            headers = {}
-            github_token = self.bot.config["github_token"]
-            if github_token is not None:
-                headers["Authorization"] = f"token {github_token}"
-
-            async with self.bot.session.get(plugin.url, headers=headers) as resp:
-                logger.debug("Downloading %s.", plugin.url)
-                raw = await resp.read()
-
-                try:
-                    raw = await resp.text()
-                except UnicodeDecodeError:
-                    pass
-                else:
-                    if raw == "Not Found":
+        # Plugins from the same repo share a cached archive
+        async with self._cache_locks[plugin.cache_path]:
+            if plugin.cache_path.exists() and not force:
+                logger.debug("Loading cached %s.", plugin.cache_path)
+            else:
+                headers = {}
+                github_token = self.bot.config["github_token"]
+                if github_token is not None:
+                    headers["Authorization"] = f"token {github_token}"
+
+                async with self._sem, self.bot.session.get(plugin.url, headers=headers) as resp:
+                    logger.debug("Downloading %s.", plugin.url)
+                    if resp.status == 404:
                         raise InvalidPluginError("Plugin not found")
-                    else:
-                        raise InvalidPluginError("Invalid download recieved, non-bytes object")
-
-                plugin_io = io.BytesIO(raw)
-                if not plugin.cache_path.parent.exists():
-                    plugin.cache_path.parent.mkdir(parents=True)
-
-                with plugin.cache_path.open("wb") as f:
-                    f.write(raw)
-
-        with zipfile.ZipFile(plugin_io) as zipf:
-            for info in zipf.infolist():
-                path = PurePath(info.filename)
-                if len(path.parts) >= 3 and path.parts[1] == plugin.name:
-                    plugin_path = plugin.abs_path / Path(*path.parts[2:])
-                    if info.is_dir():
-                        plugin_path.mkdir(parents=True, exist_ok=True)
-                    else:
-                        plugin_path.parent.mkdir(parents=True, exist_ok=True)
-                        with zipf.open(info) as src, plugin_path.open("wb") as dst:
-                            shutil.copyfileobj(src, dst)
-
-        plugin_io.close()
+                    if resp.status != 200:
+                        raise InvalidPluginError(f"Failed to download plugin (HTTP {resp.status})")
+
+                    plugin.cache_path.parent.mkdir(parents=True, exist_ok=True)
+                    part_path = plugin.cache_path.with_name(plugin.cache_path.name + ".part")
+
+                    # Only the gzip magic is sniffed, the body is never decoded as text
+                    try:
+                        magic = await resp.content.readexactly(len(_GZIP_MAGIC))
+                    except asyncio.IncompleteReadError:
+                        magic = b""
+                    if magic != _GZIP_MAGIC:
+                        raise InvalidPluginError("Invalid download received, not a tar.gz archive")
+
+                    # Stream straight to disk rather than buffering the archive in memory
+                    with part_path.open("wb") as f:
+                        f.write(magic)
+                        async for chunk in resp.content.iter_chunked(64 * 1024):
+                            f.write(chunk)
+                    part_path.replace(plugin.cache_path)
+
+        # Decompression and file writes would otherwise block the event loop
+        await self.bot.loop.run_in_executor(
+            None, _extract_plugin, plugin.cache_path, plugin.name, plugin.abs_path
+        )
 
-    async def load_plugin(self, plugin):
-        if not (plugin.abs_path / f"{plugin.name}.py").exists():
-            raise InvalidPluginError(f"{plugin.name}.py not found.")
+    async def install_batched_requirements(self, plugins):
+        """
+        Installs the requirements of all ``plugins`` with one pip run.
 
-        req_txt = plugin.abs_path / "requirements.txt"
+        Returns ``False`` if the combined install failed, in which case every
+        plugin should install its own requirements instead.
+        """
+        req_txts = [plugin.abs_path / "requirements.txt" for plugin in plugins]
+        req_txts = [req_txt for req_txt in req_txts if req_txt.exists()]
 
-        if req_txt.exists():
-            # Install PIP requirements
+        if not req_txts:
+            return True
 
-            venv = hasattr(sys, "real_prefix") or hasattr(sys, "base_prefix")  # in a virtual env
-            user_install = " --user" if not venv else ""
-            proc = await asyncio.create_subprocess_shell(
-                f'"{sys.executable}" -m pip install --upgrade{user_install} -r {req_txt} -q -q',
+        try:
+            await self.install_requirements(req_txts, "all plugins")
+        except Exception:
+            logger.warning(
+                "Batched requirements install failed, installing per plugin.", exc_info=True
+            )
+            return False
+        return True
+
+    async def install_requirements(self, req_txts, name):
+        venv = hasattr(sys, "real_prefix") or hasattr(sys, "base_prefix")  # in a virtual env
+        user_install = ["--user"] if not venv else []
+        async with self._pip_lock:
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable,
+                "-m",
+                "pip",
+                "install",
+                "--upgrade",
+                *user_install,
+                # Files are passed unmodified rather than merged, keeping nested -r/-c paths valid
+                *(arg for req_txt in req_txts for arg in ("-r", str(req_txt))),
+                "-q",
+                "-q",
                 stderr=PIPE,
                 stdout=PIPE,
             )
 
-            logger.debug("Downloading requirements for %s.", plugin.ext_string)
-
-            stdout, stderr = await proc.communicate()
-
-            if stdout:
-                logger.debug("[stdout]\n%s.", stdout.decode())
+            logger.debug("Downloading requirements for %s.", name)
 
-            if stderr:
-                logger.debug("[stderr]\n%s.", stderr.decode())
-                logger.error(
-                    "Failed to download requirements for %s.", plugin.ext_string, exc_info=True
-                )
-                raise InvalidPluginError(
-                    f"Unable to download requirements: ```\n{stderr.decode()}\n```"
+            # Pip output is logged as it arrives rather than buffered until exit
+            stderr = []
+            try:
+                await asyncio.gather(
+                    _read_lines(proc.stdout, lambda line: logger.debug("[stdout] %s", line)),
+                    _read_lines(proc.stderr, stderr.append),
                 )
+            except BaseException:
+                if proc.returncode is None:
+                    proc.kill()
+                raise
+            finally:
+                # Always reap pip, even when reading its output failed
+                await proc.wait()
+
+        if stderr:
+            stderr = "\n".join(stderr)
+            logger.debug("[stderr]\n%s.", stderr)
+            logger.error("Failed to download requirements for %s.", name, exc_info=True)
+            raise InvalidPluginError(f"Unable to download requirements: ```\n{stderr}\n```")
+
+        if USER_SITE not in sys.path and os.path.exists(USER_SITE):
+            sys.path.insert(0, USER_SITE)
+
+    async def load_plugin(self, plugin, install_requirements=True):
+        if not (plugin.abs_path / f"{plugin.name}.py").exists():
+            raise InvalidPluginError(f"{plugin.name}.py not found.")
+
+        req_txt = plugin.abs_path / "requirements.txt"
 
-            if os.path.exists(USER_SITE):
-                sys.path.insert(0, USER_SITE)
+        if install_requirements and req_txt.exists():
+            await self.install_requirements([req_txt], plugin.ext_string)
 
         try:
             self.bot.load_extension(plugin.ext_string)
@@ -264,8 +435,9 @@ class Plugins(commands.Cog):
             await ctx.send(embed=embed)
             return
 
-        if plugin_name in self.registry:
-            details = self.registry[plugin_name]
+        canonical_name = self.registry_lower.get(plugin_name.lower())
+        if canonical_name is not None:
+            details = self.registry[canonical_name]
             user, repo = details["repository"].split("/", maxsplit=1)
             branch = details.get("branch")
 
@@ -281,7 +453,7 @@ class Plugins(commands.Cog):
                     await ctx.send(embed=embed)
                     return
 
-            plugin = Plugin(user, repo, plugin_name, branch)
+            plugin = Plugin(user, repo, canonical_name, branch)
 
         else:
             try:
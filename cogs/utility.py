@@ -21,7 +21,6 @@ from aiohttp import ClientResponseError
 from discord.enums import ActivityType, Status
 from discord.ext import commands, tasks
 from discord.ext.commands.view import StringView
-from pkg_resources import parse_version
 
 from core import checks, utils
 from core.changelog import Changelog